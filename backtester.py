@@ -1,38 +1,132 @@
 # backtester.py
 import pandas as pd
 import numpy as np
+import warnings
+from collections import OrderedDict, defaultdict
+from sqlalchemy import select
 from sqlalchemy.orm import Session
-from db_schema import YearlyPortfolio, RuleBacktestMetric, Price
-from typing import Dict
+from db_schema import YearlyPortfolio, YearlyPortfolioWeight, RuleBacktestMetric
+from parallel import map_years
+from typing import Dict, Iterable
+
+RETURNS_CACHE_SIZE = 8  # yearly panels kept by get_daily_panel
+
+
+def _ffill(arr: np.ndarray) -> np.ndarray:
+    """Forward-fill NaNs down each column of a 2-D array (leading NaNs stay NaN)."""
+    idx = np.where(~np.isnan(arr), np.arange(arr.shape[0])[:, None], 0)
+    np.maximum.accumulate(idx, axis=0, out=idx)
+    return np.take_along_axis(arr, idx, axis=0)
 
 
 class PortfolioBacktester:
     def __init__(self, engine, risk_free_rate: float = 0.02):
         self.engine = engine
         self.risk_free_rate = risk_free_rate
+        # (year, company ids) -> (daily returns, observed) panels, least recently used first
+        self._returns_cache: OrderedDict[tuple[int, frozenset], tuple[pd.DataFrame, pd.DataFrame]] = OrderedDict()
 
-    def compute_portfolio_returns(self, weights: Dict[str, float], year: int) -> pd.Series:
-        """Compute daily portfolio returns given company weights for one year."""
-        with Session(self.engine) as session:
-            q = session.query(Price).filter(
-                Price.company_id.in_(list(weights.keys())),
-                Price.date.between(f"{year}-01-01", f"{year}-12-31")
+    def get_daily_returns(self, company_ids: Iterable[int], year: int) -> pd.DataFrame:
+        """Fetch one year of prices for all given companies in a single query and
+        return the daily returns panel (date x company_id). Recent panels are cached."""
+        return self.get_daily_panel(company_ids, year)[0]
+
+    def get_daily_panel(self, company_ids: Iterable[int], year: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Like get_daily_returns, but also return the matching boolean ``observed``
+        panel: True where the company had a real (not forward-filled) close that day.
+
+        The shared panel has a row for every date any company traded; a portfolio
+        only keeps the days where one of its own members did (see _weight_returns).
+        """
+        ids = frozenset(int(cid) for cid in company_ids)
+        if not ids:
+            return pd.DataFrame(), pd.DataFrame()
+
+        key = (year, ids)
+        if key in self._returns_cache:
+            self._returns_cache.move_to_end(key)
+        else:
+            self._returns_cache[key] = self._fetch_daily_returns(sorted(ids), year)
+            if len(self._returns_cache) > RETURNS_CACHE_SIZE:
+                self._returns_cache.popitem(last=False)
+        return self._returns_cache[key]
+
+    def _fetch_daily_returns(self, ids: list[int], year: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+        """Uncached price fetch + pivot behind ``get_daily_panel``."""
+        # Raw DB-API cursor: rows go straight into the DataFrame without
+        # SQLAlchemy's ORM/Core result processing.
+        raw = self.engine.raw_connection()
+        try:
+            cur = raw.cursor()
+            cur.execute(
+                # float8 cast: psycopg returns Python floats, not Decimal objects
+                "SELECT company_id, date, close::float8 AS close FROM prices "
+                "WHERE company_id = ANY(%s) AND date BETWEEN %s AND %s",
+                (ids, f"{year}-01-01", f"{year}-12-31"),
             )
-            df = pd.read_sql(q.statement, self.engine)
+            rows = cur.fetchall()
+            cur.close()
+        finally:
+            raw.close()
+
+        if not rows:
+            return pd.DataFrame(), pd.DataFrame()
+
+        df = pd.DataFrame(rows, columns=["company_id", "date", "close"])
+        df = df.pivot(index="date", columns="company_id", values="close").sort_index()
+        closes = df.to_numpy(dtype=np.float64, copy=False)
+        observed = ~np.isnan(closes[1:])
+        arr = _ffill(closes)
+        # Returns are computed in float64 but stored as float32: halves the bytes
+        # moved through the weighting matmuls, ample precision for the metrics
+        rets = (arr[1:] / arr[:-1] - 1.0).astype(np.float32)
+        return (
+            pd.DataFrame(rets, index=df.index[1:], columns=df.columns),
+            pd.DataFrame(observed, index=df.index[1:], columns=df.columns),
+        )
+
+    def compute_portfolio_returns(
+        self,
+        weights: Dict[str, float],
+        year: int,
+        daily_returns: pd.DataFrame | None = None,
+        observed: pd.DataFrame | None = None,
+    ) -> pd.Series:
+        """Compute daily portfolio returns given company weights for one year.
 
-        if df.empty:
+        Pass a pre-fetched ``daily_returns`` panel (and its ``observed`` mask from
+        get_daily_panel) to avoid hitting the database.
+        """
+        if daily_returns is None:
+            daily_returns, observed = self.get_daily_panel(weights.keys(), year)
+        return self._weight_returns(daily_returns, weights, observed)
+
+    @staticmethod
+    def _weight_returns(
+        daily_returns: pd.DataFrame, weights: Dict[str, float], observed: pd.DataFrame | None = None
+    ) -> pd.Series:
+        """Combine a daily returns panel into portfolio returns using ``weights``.
+
+        Keeps the days where every member has a return and, if ``observed`` is
+        given, at least one member had a real close: the same rows a panel built
+        from the portfolio's own companies would have.
+        """
+        if daily_returns.empty:
             return pd.Series(dtype=float)
 
-        df = df.pivot(index="date", columns="company_id", values="close").sort_index().ffill()
-        daily_returns = df.pct_change().dropna()
+        # Align weights with available companies (JSON keys are strings)
+        valid_ids = [cid for cid in weights.keys() if int(cid) in daily_returns.columns]
+        if not valid_ids:
+            return pd.Series(dtype=float)
 
-        # Align weights with available companies
-        valid_ids = [cid for cid in weights.keys() if cid in daily_returns.columns]
-        w = np.array([weights[cid] for cid in valid_ids])
+        cols = [int(cid) for cid in valid_ids]
+        w = np.array([weights[cid] for cid in valid_ids], dtype=np.float32)
         w = w / w.sum()  # normalize
-        port_returns = daily_returns[valid_ids].dot(w)
-
-        return port_returns
+        rets = daily_returns[cols].to_numpy()
+        keep = ~np.isnan(rets).any(axis=1)  # days where every member has a return
+        if observed is not None:
+            keep &= observed[cols].to_numpy().any(axis=1)
+        return pd.Series(rets[keep] @ w, index=daily_returns.index[keep])
 
     def compute_metrics(self, returns: pd.Series) -> Dict[str, float]:
         """Compute backtest metrics from daily returns."""
@@ -51,28 +145,223 @@ class PortfolioBacktester:
             sharpe=float(sharpe) if sharpe is not None else None
         )
 
-    def run_backtest(self, start_year: int, end_year: int):
-        """Run backtest for all portfolios and all weighting schemes."""
+    def compute_portfolio_metrics(self, weights: Dict[str, float], year: int) -> Dict[str, float]:
+        """Compute backtest metrics for one portfolio entirely in Postgres.
+
+        For when only the metrics are needed: returns, the weighted daily sum and
+        the mean/median/std reductions run server-side and only 4 scalars come
+        back. Mirrors compute_portfolio_returns: closes are forward-filled over
+        the dates any member traded, weights are normalized over the members
+        with prices that year, and only days where all of them have a return count.
+        """
+        if not weights:
+            return self.compute_metrics(pd.Series(dtype=float))
+
+        ids = [int(cid) for cid in weights]
+        w = [float(weights[cid]) for cid in weights]
+
+        raw = self.engine.raw_connection()
+        try:
+            cur = raw.cursor()
+            cur.execute(
+                """
+                WITH w AS (
+                    SELECT * FROM UNNEST(%s::int[], %s::float8[]) AS w(company_id, weight)
+                ), px AS (
+                    SELECT company_id, date, close::float8 AS close
+                    FROM prices
+                    WHERE company_id = ANY(%s) AND date BETWEEN %s AND %s
+                ), m AS (  -- members with prices this year, weights normalized over them
+                    SELECT company_id, weight / NULLIF(SUM(weight) OVER (), 0) AS weight
+                    FROM w WHERE company_id IN (SELECT company_id FROM px)
+                ), grid AS (  -- every (date any member traded, member), closes NULL when missing
+                    SELECT d.date, m.company_id, px.close,
+                           COUNT(px.close) OVER (PARTITION BY m.company_id ORDER BY d.date) AS grp
+                    FROM (SELECT DISTINCT date FROM px) d
+                    CROSS JOIN m
+                    LEFT JOIN px USING (date, company_id)
+                ), f AS (  -- forward-fill: each run of missing closes takes the last real one
+                    SELECT date, company_id,
+                           MAX(close) OVER (PARTITION BY company_id, grp) AS close
+                    FROM grid
+                ), r AS (
+                    SELECT date, company_id,
+                           close / NULLIF(LAG(close) OVER (PARTITION BY company_id ORDER BY date), 0) - 1 AS ret
+                    FROM f
+                ), p AS (
+                    SELECT r.date, SUM(r.ret * m.weight) AS pret
+                    FROM r JOIN m USING (company_id)
+                    GROUP BY r.date
+                    HAVING COUNT(r.ret) = (SELECT COUNT(*) FROM m)
+                )
+                SELECT count(pret), avg(pret),  -- all-zero weights: NULL returns, no days
+                       percentile_cont(0.5) WITHIN GROUP (ORDER BY pret),
+                       stddev_samp(pret)
+                FROM p
+                """,
+                (ids, w, ids, f"{year}-01-01", f"{year}-12-31"),
+            )
+            n_days, mean_ret, median_ret, std_ret = cur.fetchone()
+            cur.close()
+        finally:
+            raw.close()
+
+        if not n_days:
+            return self.compute_metrics(pd.Series(dtype=float))
+
+        mean_ret = mean_ret * 252
+        median_ret = median_ret * 252
+        vol = std_ret * np.sqrt(252) if std_ret is not None else float("nan")
+        sharpe = (mean_ret - self.risk_free_rate) / vol if vol > 0 else None
+
+        return dict(
+            mean_return=float(mean_ret),
+            median_return=float(median_ret),
+            volatility=float(vol),
+            sharpe=float(sharpe) if sharpe is not None else None
+        )
+
+    def compute_metrics_batch(
+        self,
+        daily_returns: pd.DataFrame,
+        weight_sets: list[Dict[str, float]],
+        observed: pd.DataFrame | None = None,
+    ) -> list[Dict[str, float]]:
+        """Compute backtest metrics for many portfolios sharing one returns panel.
+
+        Portfolio returns are stacked into a (n_days, n_portfolios) matrix so the
+        mean/median/std reductions run once, column-wise, in NumPy. Days are
+        filtered per portfolio as in _weight_returns.
+        """
+        empty = dict(mean_return=None, median_return=None, volatility=None, sharpe=None)
+        if daily_returns.empty or not weight_sets:
+            return [dict(empty) for _ in weight_sets]
+
+        col_idx = {cid: i for i, cid in enumerate(daily_returns.columns)}
+        W = np.zeros((len(col_idx), len(weight_sets)), dtype=np.float32)
+        member = np.zeros_like(W)
+        for j, weights in enumerate(weight_sets):
+            for cid, w in weights.items():
+                i = col_idx.get(int(cid))
+                if i is not None:
+                    W[i, j] = w
+                    member[i, j] = 1.0
+        with np.errstate(divide="ignore", invalid="ignore"):  # empty portfolios
+            W = W / W.sum(axis=0)  # normalize
+
+        arr = daily_returns.to_numpy(dtype=np.float32)
+        missing = np.isnan(arr)
+        # A day only counts for a portfolio if all its members have a return
+        # (same rows the per-portfolio dropna() kept)
+        invalid = (missing @ member) > 0
+        invalid[:, ~member.any(axis=0)] = True
+        if observed is not None:
+            # ...and at least one member really traded: on days only other
+            # companies traded, the members' forward-filled 0% returns are dropped
+            invalid |= (observed.to_numpy(dtype=np.float32) @ member) == 0
+        R = (np.where(missing, np.float32(0), arr) @ np.nan_to_num(W)).astype(np.float64)
+        R[invalid] = np.nan
+        counts = (~invalid).sum(axis=0)
+
+        with warnings.catch_warnings():  # all-NaN / single-row columns
+            warnings.simplefilter("ignore", RuntimeWarning)
+            mean_ret = np.nanmean(R, axis=0) * 252
+            median_ret = np.nanmedian(R, axis=0) * 252
+            vol = np.nanstd(R, axis=0, ddof=1) * np.sqrt(252)
+
+        results = []
+        for j in range(len(weight_sets)):
+            if counts[j] == 0:
+                results.append(dict(empty))
+                continue
+            sharpe = (mean_ret[j] - self.risk_free_rate) / vol[j] if vol[j] > 0 else None
+            results.append(dict(
+                mean_return=float(mean_ret[j]),
+                median_return=float(median_ret[j]),
+                volatility=float(vol[j]),
+                sharpe=float(sharpe) if sharpe is not None else None
+            ))
+        return results
+
+    def backtest_year(self, year: int, year_portfolios: list[tuple]) -> list[dict]:
+        """Compute metric rows for every (rule, scheme) portfolio of one year.
+
+        ``year_portfolios`` holds (rule_id, weights) pairs, where weights maps
+        scheme -> {company_id: weight}.
+        """
+        # weights contains multiple schemes per portfolio
+        entries = [
+            (rule_id, scheme, weights)
+            for rule_id, portfolio_weights in year_portfolios
+            for scheme, weights in portfolio_weights.items()
+        ]
+        all_ids = set().union(*[weights.keys() for _, _, weights in entries])
+        daily_returns, observed = self.get_daily_panel(all_ids, year)
+
+        batch = self.compute_metrics_batch(daily_returns, [weights for _, _, weights in entries], observed)
+        return [
+            {"rule_id": rule_id, "year": year, "scheme": scheme, **metrics}
+            for (rule_id, scheme, _), metrics in zip(entries, batch)
+        ]
+
+    def run_backtest(self, start_year: int, end_year: int, max_workers: int | None = None):
+        """Run backtest for all portfolios and all weighting schemes, one year per
+        worker process (see parallel.map_years for ``max_workers``)."""
         with Session(self.engine) as session:
-            portfolios = session.query(YearlyPortfolio).filter(
-                YearlyPortfolio.year.between(start_year, end_year)
+            # Typed (portfolio, scheme, company, weight) tuples from the normalized
+            # weights table: no JSON decoding, no ORM identity map or lazy loads
+            rows = session.execute(
+                select(
+                    YearlyPortfolio.id,
+                    YearlyPortfolio.rule_id,
+                    YearlyPortfolio.year,
+                    YearlyPortfolioWeight.scheme,
+                    YearlyPortfolioWeight.company_id,
+                    YearlyPortfolioWeight.weight,
+                )
+                .join(YearlyPortfolioWeight, YearlyPortfolioWeight.portfolio_id == YearlyPortfolio.id)
+                .where(YearlyPortfolio.year.between(start_year, end_year))
             ).all()
 
-            for yp in portfolios:
-                for scheme, weights in yp.weights.items():  # weights contains multiple schemes
-                    returns = self.compute_portfolio_returns(weights, yp.year)
-                    metrics = self.compute_metrics(returns)
-
-                    rbm = RuleBacktestMetric(
-                        rule_id=yp.rule_id,
-                        year=yp.year,
-                        scheme=scheme,
-                        mean_return=metrics["mean_return"],
-                        median_return=metrics["median_return"],
-                        volatility=metrics["volatility"],
-                        sharpe=metrics["sharpe"],
-                    )
-                    session.add(rbm)
-
-            session.commit()
-            print(f"✅ Backtest complete for {start_year}-{end_year}")
+        # Group by year so prices are fetched once per year, not once per portfolio:
+        # year -> portfolio_id -> (rule_id, {scheme: {company_id: weight}})
+        by_year = defaultdict(dict)
+        for portfolio_id, rule_id, year, scheme, company_id, weight in rows:
+            _, schemes = by_year[year].setdefault(portfolio_id, (rule_id, {}))
+            schemes.setdefault(scheme, {})[company_id] = weight
+
+        tasks = [
+            (self.risk_free_rate, year, list(year_portfolios.values()))
+            for year, year_portfolios in sorted(by_year.items())
+        ]
+        metrics_rows = [
+            row for rows in map_years(self.engine, _backtest_year, tasks, max_workers) for row in rows
+        ]
+
+        self.write_metrics(metrics_rows)
+        print(f"✅ Backtest complete for {start_year}-{end_year}")
+
+    def write_metrics(self, metrics_rows: list[dict]):
+        """Insert RuleBacktestMetric rows in psycopg pipeline mode, so the INSERTs are
+        sent back-to-back without waiting for each server response."""
+        if not metrics_rows:
+            return
+
+        cols = ["rule_id", "year", "scheme", "mean_return", "median_return", "volatility", "sharpe"]
+        sql = (
+            f"INSERT INTO {RuleBacktestMetric.__tablename__} ({', '.join(cols)}) "
+            f"VALUES ({', '.join(['%s'] * len(cols))})"
+        )
+        raw = self.engine.raw_connection()
+        try:
+            with raw.driver_connection.pipeline():
+                cur = raw.cursor()
+                cur.executemany(sql, [[row[c] for c in cols] for row in metrics_rows])
+                cur.close()
+            raw.commit()
+        finally:
+            raw.close()
+
+
+def _backtest_year(engine, risk_free_rate: float, year: int, year_portfolios: list[tuple]) -> list[dict]:
+    return PortfolioBacktester(engine, risk_free_rate).backtest_year(year, year_portfolios)
@@ -0,0 +1,42 @@
+# parallel.py
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+_engine = None  # the parent's Engine, inherited by forked workers
+
+
+def map_years(engine, fn, tasks, max_workers: int | None = None) -> list:
+    """Return ``[fn(engine, *task) for task in tasks]``, spread over a process pool.
+
+    Years are independent, so callers pass one task per year. ``fn`` must be a
+    module-level function. ``max_workers`` defaults to the CPU count; 1, or a
+    platform without fork, runs in-process. Forked workers reuse the parent's
+    Engine, so every create_engine option (connect_args, pool settings...) carries over.
+    """
+    if max_workers == 1 or "fork" not in multiprocessing.get_all_start_methods():
+        return [fn(engine, *task) for task in tasks]
+
+    global _engine
+    _engine = engine
+    try:
+        with ProcessPoolExecutor(
+            max_workers=max_workers or os.cpu_count(),
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=_init_worker,
+        ) as ex:
+            return list(ex.map(_run, [(fn, task) for task in tasks]))
+    finally:
+        _engine = None
+
+
+def _init_worker():
+    # Pooled connections can't be shared across processes: give the child a fresh
+    # pool without closing the parent's sockets.
+    _engine.dispose(close=False)
+
+
+def _run(job):
+    fn, task = job
+    return fn(_engine, *task)
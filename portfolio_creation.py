@@ -1,38 +1,71 @@
 # portfolio_creation.py
 
+from datetime import date
+import numpy as np
+import pandas as pd
 from sqlalchemy.orm import Session
 from db_schema import Company, Financial, Rule, YearlyPortfolio, Metric
 import json
-from sqlalchemy import and_
+from sqlalchemy import or_, select
+from parallel import map_years
+
+FILTER_OPS = {
+    ">": np.greater,
+    "<": np.less,
+    ">=": np.greater_equal,
+    "<=": np.less_equal,
+}
+
+MARKET_CAP = "market_cap"
 
 # RENAMED for clarity from Backtester to PortfolioGenerator
 class PortfolioGenerator:
-    def __init__(self, engine):
+    def __init__(self, engine, market_cap_metric_id: int | None = None):
         self.engine = engine
+        # Looked up once (or handed over by run_backtest); used to pull market
+        # caps for ranking in every portfolio
+        if market_cap_metric_id is None:
+            with Session(engine) as session:
+                market_cap_metric_id = session.scalar(
+                    select(Metric.id).where(Metric.name == MARKET_CAP)
+                )
+        self._market_cap_metric_id = market_cap_metric_id
 
-    def get_market_cap_for_sorting(self, session, company_ids: list[int], year: int):
-        """
-        FIX: Fetches market cap from the end of the *previous* year for sorting.
-        """
-        if not company_ids:
-            return {}
-
-        # Look for the 'market_cap' metric
-        market_cap_metric = session.query(Metric).filter(Metric.name == 'market_cap').first()
-        if not market_cap_metric:
-            # Fallback if no market_cap metric is defined
-            return {cid: 0 for cid in company_ids}
-
-        # Query financials for the previous year
-        # Data available at the start of 'year' is from the end of 'year - 1'
-        financials = session.query(Financial).filter(
-            Financial.company_id.in_(company_ids),
-            Financial.metric_id == market_cap_metric.id,
-            Financial.period_label.endswith(str(year - 1)) # Use previous year's data
-        ).all()
+    @staticmethod
+    def _select_top(rows, filters, universe=None, top_n: int = 20) -> list[int]:
+        """Evaluate all filters on (company_id, metric_name, value) rows at once and
+        return the top_n passing companies by market cap, largest first.
 
-        return {f.company_id: f.value for f in financials}
+        Market cap comes from the same rows (metric 'market_cap'); companies
+        without one rank last, as if it were 0. If a company has several rows for
+        a metric, the last one wins, so pass rows ordered oldest to latest.
+        """
+        df = pd.DataFrame.from_records(rows, columns=["company_id", "name", "value"])
+        if df.empty:
+            wide = pd.DataFrame(index=pd.Index([], name="company_id"))
+        else:
+            wide = df.pivot_table(index="company_id", columns="name", values="value", aggfunc="last")
+        if universe is not None:
+            wide = wide.reindex(universe)
+        if len(wide) == 0:
+            return []
 
+        # Plain 2-D array + column positions: each filter is one vectorized compare
+        col_idx = {name: i for i, name in enumerate(wide.columns)}
+        arr = wide.to_numpy(dtype=float)
+        mask = np.ones(arr.shape[0], dtype=bool)
+        for f in filters:
+            if f["name"] not in col_idx:
+                return []  # no company has this metric, so none can pass
+            FILTER_OPS[f["sign"]](arr[:, col_idx[f["name"]]], float(f["threshold"]), out=mask, where=mask)
+
+        if MARKET_CAP in col_idx:
+            market_caps = np.nan_to_num(arr[mask, col_idx[MARKET_CAP]], nan=0.0)
+        else:
+            market_caps = np.zeros(mask.sum())
+        eligible = wide.index.to_numpy()[mask]
+        order = np.argsort(-market_caps, kind="stable")[:top_n]
+        return [int(cid) for cid in eligible[order]]
 
     def generate_portfolio(self, rule: Rule, year: int):
         """
@@ -42,49 +75,36 @@ class PortfolioGenerator:
         if not filters:
             return []
 
+        # Skip filters with an invalid sign
+        valid_filters = [f for f in filters if f["sign"] in FILTER_OPS]
+
         with Session(self.engine) as session:
-            # Start with a query for all company IDs
-            q = session.query(Company.id)
-
-            # Dynamically build the query by joining and filtering for each rule
-            for f in filters:
-                # Alias is needed for each join to be unique
-                financial_alias = Financial.__table__.alias()
-                metric_alias = Metric.__table__.alias()
-
-                # Define the join condition
-                join_condition = and_(
-                    Company.id == financial_alias.c.company_id,
-                    financial_alias.c.metric_id == metric_alias.c.id,
-                    metric_alias.c.name == f["name"],
+            universe = None
+            if not valid_filters:
+                universe = list(session.execute(select(Company.id)).scalars())
+
+            # One scan for every (company, metric, value) the filters need plus the
+            # market caps used for ranking, instead of one self-join per filter
+            # and a second market-cap query
+            stmt = (
+                select(Financial.company_id, Metric.name, Financial.value)
+                .join(Metric, Financial.metric_id == Metric.id)
+                .where(
+                    or_(
+                        Metric.name.in_(sorted({f["name"] for f in valid_filters})),
+                        Financial.metric_id == self._market_cap_metric_id,
+                    ),
                     # <-- FIX: Use previous year's data to avoid lookahead bias
-                    financial_alias.c.period_label.endswith(str(year - 1))
+                    Financial.period_end.between(date(year - 1, 1, 1), date(year - 1, 12, 31)),
                 )
+                # Latest value in the year wins when a metric has several periods
+                .order_by(Financial.period_end, Financial.id)
+            )
+            # Stream plain tuples in batches instead of materializing all Row objects
+            rows = session.execute(stmt.execution_options(yield_per=1000)).tuples()
 
-                # Define the filter condition on the value
-                if f["sign"] == ">":
-                    filter_condition = financial_alias.c.value > f["threshold"]
-                elif f["sign"] == "<":
-                    filter_condition = financial_alias.c.value < f["threshold"]
-                elif f["sign"] == ">=":
-                    filter_condition = financial_alias.c.value >= f["threshold"]
-                elif f["sign"] == "<=":
-                    filter_condition = financial_alias.c.value <= f["threshold"]
-                else:
-                    continue # Skip invalid sign
-
-                # Apply the join and filter to the main query
-                q = q.join(financial_alias, join_condition).filter(filter_condition)
-
-            # Execute the query to get IDs of eligible companies
-            eligible_company_ids = [result[0] for result in q.distinct().all()]
-
-            # Fetch market caps for sorting the eligible companies
-            market_caps = self.get_market_cap_for_sorting(session, eligible_company_ids, year)
-
-            # Sort by market cap descending and take top 20
-            eligible_company_ids.sort(key=lambda cid: market_caps.get(cid, 0), reverse=True)
-            top_company_ids = eligible_company_ids[:20]
+            # Top 20 eligible companies by market cap, descending
+            top_company_ids = self._select_top(rows, valid_filters, universe)
 
             if not top_company_ids:
                 print(f"⚠️ No companies found for rule {rule.id} in year {year}")
@@ -99,6 +119,7 @@ class PortfolioGenerator:
 
             if existing_portfolio:
                 existing_portfolio.weights = portfolio_weights_placeholder
+                existing_portfolio.weight_rows.clear()  # old company set must not be backtested
             else:
                 new_portfolio = YearlyPortfolio(
                     rule_id=rule.id,
@@ -111,12 +132,25 @@ class PortfolioGenerator:
             return top_company_ids
 
 
-    def run_backtest(self, start_year: int, end_year: int):
-        """Run portfolio generation for all rules from start_year to end_year."""
+    def run_backtest(self, start_year: int, end_year: int, max_workers: int | None = None):
+        """Run portfolio generation for all rules from start_year to end_year, one
+        year per worker process (see parallel.map_years for ``max_workers``)."""
+        # Rules and the market-cap id are loaded once and shipped with each year's task
         with Session(self.engine) as session:
             rules = session.query(Rule).all()
+        tasks = [(self._market_cap_metric_id, rules, year) for year in range(start_year, end_year + 1)]
+        map_years(self.engine, _generate_year, tasks, max_workers)
+        print(f"✅ Portfolio generation complete for {start_year}-{end_year}")
+
+    def generate_year(self, year: int, rules: list[Rule] | None = None):
+        """Generate the portfolio of every rule (default: all in the database) for one year."""
+        if rules is None:
+            with Session(self.engine) as session:
+                rules = session.query(Rule).all()
 
         for rule in rules:
-            for year in range(start_year, end_year + 1):
-                self.generate_portfolio(rule, year)
-        print(f"✅ Portfolio generation complete for {start_year}-{end_year}")
\ No newline at end of file
+            self.generate_portfolio(rule, year)
+
+
+def _generate_year(engine, market_cap_metric_id: int | None, rules: list[Rule], year: int):
+    PortfolioGenerator(engine, market_cap_metric_id).generate_year(year, rules)
@@ -2,68 +2,148 @@
 
 import pandas as pd
 import numpy as np
+from dataclasses import dataclass, field
+from sqlalchemy import select, text
 from sqlalchemy.orm import Session
-from db_schema import Financial, Price, Metric  # <-- Import Metric
-from typing import Literal
+from db_schema import Metric
+from typing import Literal, Optional
 from datetime import date, timedelta
 
+PRICE_CHUNK_ROWS = 200_000
+
+
+@dataclass
+class WeightingInputs:
+    """Pre-fetched data shared by the weighting schemes for one (company set, year)."""
+    market_caps: Optional[pd.DataFrame] = None  # previous-year market cap rows
+    prices: Optional[pd.DataFrame] = None  # volatility lookback window
+    momentum: Optional[pd.Series] = None  # company_id -> momentum over the window
+    # (company set, schemes, lookback_vol) -> weights already computed from this data.
+    # Rules' top-N universes overlap heavily, so the same set often comes back.
+    weights: dict = field(default_factory=dict, repr=False)
+
+
 class PortfolioWeightingEngine:
     def __init__(self, engine):
         self.engine = engine
+        self._metric_ids = {}  # metric name -> id (None if undefined), looked up once
+
+    def _metric_id(self, session, name):
+        if name not in self._metric_ids:
+            self._metric_ids[name] = session.scalar(select(Metric.id).where(Metric.name == name))
+        return self._metric_ids[name]
+
+    # ----------------------------
+    # Data access
+    # ----------------------------
+
+    def _fetch_market_caps(self, session, company_ids, year):
+        """Previous-year market cap rows, or None if no market_cap metric is defined."""
+        market_cap_id = self._metric_id(session, 'market_cap')
+        if market_cap_id is None:
+            return None
+
+        # Query the financials table for the previous year-end's data.
+        # One array parameter instead of an IN list with a bind per company.
+        rows = session.execute(
+            text("""
+                SELECT company_id, value
+                FROM financials
+                WHERE company_id = ANY(:ids) AND metric_id = :mid
+                  AND period_end BETWEEN :s AND :e
+            """),
+            # <-- FIX: Use data from year-1, which is known at the start of 'year'
+            {"ids": [int(cid) for cid in company_ids], "mid": market_cap_id,
+             "s": date(year - 1, 1, 1), "e": date(year - 1, 12, 31)},
+        ).mappings().all()
+        return pd.DataFrame(rows, columns=['company_id', 'value'])
+
+    def _fetch_prices(self, company_ids, start_date, end_date):
+        """(company_id, date, close) rows read straight off a psycopg server-side
+        cursor in chunks: no SQLAlchemy row processing or read_sql conversion, and
+        multi-year pulls are never held in memory several times over."""
+        cols = ['company_id', 'date', 'close']
+        chunks = []
+        raw = self.engine.raw_connection()
+        try:
+            cur = raw.driver_connection.cursor(name="weighting_prices")
+            cur.execute(
+                "SELECT company_id, date, close::float4 FROM prices "
+                "WHERE company_id = ANY(%s) AND date BETWEEN %s AND %s",
+                ([int(cid) for cid in company_ids], start_date, end_date),
+            )
+            while rows := cur.fetchmany(PRICE_CHUNK_ROWS):
+                chunks.append(pd.DataFrame(rows, columns=cols))
+            cur.close()
+        finally:
+            raw.close()
+
+        if not chunks:
+            return pd.DataFrame({c: pd.Series(dtype=t) for c, t in zip(cols, ['int64', 'object', 'float32'])})
+        return pd.concat(chunks, ignore_index=True).astype({'close': 'float32'})
+
+    def _fetch_momentum(self, session, company_ids, year, momentum_period):
+        """Momentum (last / first close - 1) per company. Only the first and last
+        price in the window are read, each with one (company_id, date) index probe
+        per company. Companies with < 2 prices are omitted."""
+        end_date, start_date = _momentum_window(year, momentum_period)
+        rows = session.execute(
+            text("""
+                SELECT c.company_id, CAST(l.close / NULLIF(f.close, 0) - 1 AS float8) AS mom
+                FROM unnest(CAST(:ids AS bigint[])) AS c(company_id)
+                CROSS JOIN LATERAL (
+                    SELECT date, close FROM prices p
+                    WHERE p.company_id = c.company_id AND p.date BETWEEN :s AND :e
+                    ORDER BY p.date LIMIT 1
+                ) f
+                CROSS JOIN LATERAL (
+                    SELECT date, close FROM prices p
+                    WHERE p.company_id = c.company_id AND p.date BETWEEN :s AND :e
+                    ORDER BY p.date DESC LIMIT 1
+                ) l
+                WHERE l.date > f.date
+            """),
+            {"ids": sorted({int(cid) for cid in company_ids}), "s": start_date, "e": end_date},
+        ).all()
+        # A zero first close gives NULL: omitted, so reindexing treats it as 0 momentum
+        return pd.Series(dict(rows), dtype=float).dropna()
+
+    def prefetch(self, company_ids, year, schemes=None, lookback_vol: int = 252, momentum_period: int = 252):
+        """Fetch everything the given schemes (default: all) need in one session:
+        previous-year market caps, the volatility price window and per-company
+        momentum. ``company_ids`` may be a superset shared by several portfolios."""
+        if schemes is None:
+            schemes = list(WEIGHTERS)
+        data = WeightingInputs()
+        with Session(self.engine) as session:
+            if 'market_cap' in schemes:
+                data.market_caps = self._fetch_market_caps(session, company_ids, year)
+            if 'inverse_vol' in schemes:
+                end_date, start_date = _vol_window(year, lookback_vol)
+                data.prices = self._fetch_prices(company_ids, start_date, end_date)
+            if 'momentum' in schemes:
+                data.momentum = self._fetch_momentum(session, company_ids, year, momentum_period)
+        return data
 
     def get_market_caps(self, company_ids, year):
         """
         FIX: Fetch market cap data from the end of the PREVIOUS year.
         """
         with Session(self.engine) as session:
-            # Find the market_cap metric ID
-            market_cap_metric = session.query(Metric).filter(Metric.name == 'market_cap').first()
-            if not market_cap_metric:
-                return pd.Series(1, index=company_ids) # Fallback
-
-            # Query the financials table for the previous year-end's data
-            q = session.query(Financial)
-            q = q.filter(Financial.company_id.in_(company_ids))
-            # <-- FIX: Use data from year-1, which is known at the start of 'year'
-            q = q.filter(Financial.period_label.endswith(str(year - 1)))
-            q = q.filter(Financial.metric_id == market_cap_metric.id)
-            df = pd.read_sql(q.statement, self.engine)
-
-        if df.empty:
-            return pd.Series(1, index=company_ids)  # fallback to equal weight
-        
-        # Ensure company_id is the index
-        df = df.set_index('company_id')
-        # Reindex to ensure all requested company_ids are present, fill missing with 1
-        return df['value'].reindex(company_ids, fill_value=1.0)
-
+            df_fin = self._fetch_market_caps(session, company_ids, year)
+        return _market_caps(df_fin, company_ids)
 
     def get_volatility(self, company_ids, year, lookback=252):
         """
         FIX: Compute annualized volatility from prices in the year PRIOR to measurement.
         """
-        # <-- FIX: Calculate dates to avoid lookahead bias.
-        end_date = date(year, 1, 1) - timedelta(days=1)
-        start_date = end_date - timedelta(days=int(lookback * 1.5)) # Fetch a bit more data
+        end_date, start_date = _vol_window(year, lookback)
+        df_px = self._fetch_prices(company_ids, start_date, end_date)
+        return _volatility(df_px, company_ids, lookback)
 
-        with Session(self.engine) as session:
-            q = session.query(Price)
-            q = q.filter(Price.company_id.in_(company_ids))
-            q = q.filter(Price.date.between(start_date, end_date))
-            df = pd.read_sql(q.statement, self.engine)
-
-        if df.empty:
-            return pd.Series(1, index=company_ids)
-
-        vol_dict = {}
-        for cid in company_ids:
-            prices = df[df['company_id'] == cid].sort_values('date')['close'].tail(lookback)
-            if len(prices) < 2:
-                vol_dict[cid] = 0.2  # default 20%
-            else:
-                ret = prices.pct_change().dropna()
-                vol_dict[cid] = ret.std() * np.sqrt(252)
-        return pd.Series(vol_dict)
+    # ----------------------------
+    # Weighting
+    # ----------------------------
 
     def compute_weights(
         self,
@@ -76,61 +156,12 @@ class PortfolioWeightingEngine:
         """Compute portfolio weights based on selected scheme."""
         if not company_ids:
             return {}
-        
-        # Convert IDs to string for JSON compatibility in the final dict
-        str_company_ids = [str(cid) for cid in company_ids]
-
-        if scheme == 'equal':
-            n = len(str_company_ids)
-            return {cid: 1/n for cid in str_company_ids}
-        
-        elif scheme == 'market_cap':
-            mcaps = self.get_market_caps(company_ids, year)
-            weights = mcaps / mcaps.sum()
-            return {str(k): v for k, v in weights.to_dict().items()}
-
-        elif scheme == 'inverse_vol':
-            vols = self.get_volatility(company_ids, year, lookback=lookback_vol)
-            inv_vols = 1 / (vols + 1e-8) # Add small epsilon to avoid division by zero
-            weights = inv_vols / inv_vols.sum()
-            return {str(k): v for k, v in weights.to_dict().items()}
-
-        elif scheme == 'momentum':
-            # <-- FIX: Calculate dates to avoid lookahead bias
-            end_date = date(year, 1, 1) - timedelta(days=1)
-            start_date = end_date - timedelta(days=momentum_period)
-
-            with Session(self.engine) as session:
-                q = session.query(Price)
-                q = q.filter(Price.company_id.in_(company_ids))
-                q = q.filter(Price.date.between(start_date, end_date))
-                df = pd.read_sql(q.statement, self.engine)
-
-            mom_dict = {}
-            for cid in company_ids:
-                prices = df[df['company_id'] == cid].sort_values('date')['close']
-                if len(prices) < 2:
-                    mom_dict[cid] = 0.0
-                else:
-                    # Ensure we use the actual first and last price in the window
-                    mom_dict[cid] = (prices.iloc[-1] / prices.iloc[0]) - 1
-            
-            mom_series = pd.Series(mom_dict)
-            mom_series[mom_series < 0] = 0  # avoid negative weights
-            
-            if mom_series.sum() > 0:
-                weights = mom_series / mom_series.sum()
-            else:
-                # Fallback to equal weight if all momentums are zero or negative
-                weights = pd.Series(1/len(company_ids), index=company_ids)
-            return {str(k): v for k, v in weights.to_dict().items()}
-        else:
+        if scheme not in WEIGHTERS:
             raise ValueError(f"Unknown weighting scheme: {scheme}")
 
-    # compute_all_weights and save_weights_to_db remain the same, as the logic
-    # within compute_weights is what needed fixing. I've updated compute_weights
-    # to return string keys for JSON compatibility.
-    
+        data = self.prefetch(company_ids, year, [scheme], lookback_vol, momentum_period)
+        return WEIGHTERS[scheme](company_ids, data, lookback_vol)
+
     def compute_all_weights(
         self,
         company_ids,
@@ -139,15 +170,132 @@ class PortfolioWeightingEngine:
         lookback_vol: int = 252,
         momentum_period: int = 252
     ) -> dict[str, dict[str, float]]:
-        """Compute weights for all schemes and return as a dict of dicts."""
-        all_weights = {}
+        """Compute weights for all schemes and return as a dict of dicts.
+
+        Market caps, prices and momentum are fetched once and shared by every scheme.
+        """
+        if not company_ids:
+            return {scheme: {} for scheme in schemes}
         for scheme in schemes:
-            all_weights[scheme] = self.compute_weights(
-                company_ids=company_ids,
-                year=year,
-                scheme=scheme,
-                lookback_vol=lookback_vol,
-                momentum_period=momentum_period
-            )
-        return all_weights
+            if scheme not in WEIGHTERS:
+                raise ValueError(f"Unknown weighting scheme: {scheme}")
+
+        data = self.prefetch(company_ids, year, schemes, lookback_vol, momentum_period)
+        return self.weights_from_inputs(company_ids, data, schemes, lookback_vol)
+
+    def weights_from_inputs(
+        self,
+        company_ids,
+        data: WeightingInputs,
+        schemes: list[str] = ['equal', 'market_cap', 'inverse_vol', 'momentum'],
+        lookback_vol: int = 252
+    ) -> dict[str, dict[str, float]]:
+        """Compute weights for all schemes from already-fetched inputs (see prefetch).
+
+        Results are memoized on ``data``, so portfolios of one year sharing a
+        company set are weighted once.
+        """
+        key = (frozenset(int(cid) for cid in company_ids), tuple(schemes), lookback_vol)
+        if key not in data.weights:
+            data.weights[key] = {
+                scheme: WEIGHTERS[scheme](company_ids, data, lookback_vol) for scheme in schemes
+            }
+        return {scheme: dict(w) for scheme, w in data.weights[key].items()}  # callers may mutate
+
+
+# ----------------------------
+# Pure helpers on pre-fetched frames
+# ----------------------------
+
+def _vol_window(year, lookback):
+    # <-- FIX: Calculate dates to avoid lookahead bias.
+    end_date = date(year, 1, 1) - timedelta(days=1)
+    start_date = end_date - timedelta(days=int(lookback * 1.5)) # Fetch a bit more data
+    return end_date, start_date
+
+
+def _momentum_window(year, momentum_period):
+    # <-- FIX: Calculate dates to avoid lookahead bias
+    end_date = date(year, 1, 1) - timedelta(days=1)
+    start_date = end_date - timedelta(days=momentum_period)
+    return end_date, start_date
+
+
+def _market_caps(df_fin, company_ids):
+    if df_fin is None or df_fin.empty:
+        return pd.Series(1, index=company_ids)  # fallback to equal weight
+
+    # Ensure company_id is the index
+    df = df_fin.set_index('company_id')
+    # Reindex to ensure all requested company_ids are present, fill missing with 1
+    return df['value'].reindex(company_ids, fill_value=1.0)
+
+
+def _annualized_std(rets):
+    """Column-wise annualized sample std (ddof=1) of a returns matrix, ignoring
+    NaNs, from one pass of sums and sums of squares. NaN where a column has
+    fewer than 2 returns. Sums accumulate in float64 whatever the input dtype."""
+    valid = ~np.isnan(rets)
+    r = np.where(valid, rets, 0)
+    c = valid.sum(axis=0)
+    s = r.sum(axis=0, dtype=np.float64)
+    s2 = np.square(r, dtype=np.float64).sum(axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var = (s2 - s * s / c) / (c - 1)
+    var[c < 2] = np.nan
+    return np.sqrt(np.maximum(var, 0.0) * 252)
+
+
+def _volatility(df, company_ids, lookback):
+    df = df[df['company_id'].isin(company_ids)]
+    if df.empty:
+        return pd.Series(1, index=company_ids)
+
+    # Each company's own last `lookback` closes and the returns between them, as
+    # the per-company loop had; only then pivot, so companies trading on
+    # different days don't punch holes in each other's return series
+    df = df.sort_values(['company_id', 'date']).groupby('company_id').tail(lookback)
+    rets = df['close'] / df.groupby('company_id')['close'].shift(1) - 1  # float32, like the closes
+    wide = df.assign(ret=rets).dropna(subset=['ret']).pivot(index='date', columns='company_id', values='ret')
+
+    # date x company return matrix; every column reduced in one NumPy call
+    vols = pd.Series(_annualized_std(wide.to_numpy(dtype=np.float32)), index=wide.columns)
+    return vols.reindex(company_ids).fillna(0.2)  # fewer than 2 returns: default 20%
+
+
+def _weights_equal(company_ids, data, lookback_vol):
+    # Convert IDs to string for JSON compatibility in the final dict
+    return dict.fromkeys(map(str, company_ids), 1 / len(company_ids))
+
+
+def _weights_mcap(company_ids, data, lookback_vol):
+    mcaps = _market_caps(data.market_caps, company_ids)
+    weights = mcaps / mcaps.sum()
+    return {str(k): v for k, v in weights.to_dict().items()}
+
+
+def _weights_ivol(company_ids, data, lookback_vol):
+    vols = _volatility(data.prices, company_ids, lookback_vol)
+    inv_vols = 1 / (vols + 1e-8) # Add small epsilon to avoid division by zero
+    weights = inv_vols / inv_vols.sum()
+    return {str(k): v for k, v in weights.to_dict().items()}
+
+
+def _weights_mom(company_ids, data, lookback_vol):
+    mom_series = data.momentum.reindex(company_ids, fill_value=0.0)
+    mom_series[mom_series < 0] = 0  # avoid negative weights
+
+    if mom_series.sum() > 0:
+        weights = mom_series / mom_series.sum()
+    else:
+        # Fallback to equal weight if all momentums are zero or negative
+        return _weights_equal(company_ids, data, lookback_vol)
+    return {str(k): v for k, v in weights.to_dict().items()}
+
 
+WEIGHTERS = {
+    'equal': _weights_equal,
+    'market_cap': _weights_mcap,
+    'inverse_vol': _weights_ivol,
+    'momentum': _weights_mom,
+}
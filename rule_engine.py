@@ -1,13 +1,54 @@
-import random
+import copy
+import functools
+import numpy as np
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import text
 from db_schema import Rule, Filter  # assumes both are in db_schema.py
 
 
+SIGNS = np.array([">", "<", ">=", "<="])
+PERIODS = np.array(["1Y", "3Y", "5Y", "10Y"])
+TWEAK_TYPES = np.array(["threshold", "sign", "period"])
+
+# Threshold distribution per filter bucket: (low, high, kind)
+_BUCKETS = {
+    "pct": (5, 30, "int"),
+    "ratio": (5, 40, "float"),
+    "debt": (0, 10, "int"),
+    "div": (0.5, 8.0, "float"),
+    "default": (1, 100, "float"),
+}
+
+
+def _classify(name, unit):
+    """Threshold bucket for a filter, from its name and unit."""
+    if unit == "%" or "ROE" in name or "ROCE" in name:
+        return "pct"
+    if "PE" in name or "PB" in name:
+        return "ratio"
+    if "Debt" in name:
+        return "debt"
+    if "Dividend" in name:
+        return "div"
+    return "default"
+
+
+@functools.lru_cache(maxsize=8)
+def _filter_catalog(engine):
+    """All Filter rows, loaded once per engine (call ``cache_clear()`` after
+    changing the filters table). Each row is tagged with its ``_bucket``."""
+    with Session(engine) as session:
+        filters = session.query(Filter).all()
+    for f in filters:
+        f._bucket = _classify(f.name, f.unit)
+    return filters
+
+
 class RuleEvolutionEngine:
-    def __init__(self, engine):
+    def __init__(self, engine, seed=None):
         self.engine = engine
+        self._rng = np.random.default_rng(seed)
 
     def _fix_rule_id_sequence(self, session):
         """Fix Postgres sequence if it's out of sync with rules.id."""
@@ -21,122 +62,151 @@ class RuleEvolutionEngine:
         session.commit()
         print("🔄 Fixed rules.id sequence")
 
-    def _safe_commit(self, session):
-        """Commit with auto-repair for duplicate key errors."""
+    def _safe_commit(self, session, new_objects=()):
+        """Commit with auto-repair for duplicate key errors.
+
+        The rollback discards pending objects, so ``new_objects`` are added
+        again before the retry.
+        """
         try:
             session.commit()
         except IntegrityError as e:
             if "duplicate key value violates unique constraint" in str(e):
                 session.rollback()
                 self._fix_rule_id_sequence(session)
+                session.add_all(new_objects)
                 session.commit()
             else:
                 raise
 
+    def _tweak(self, rules, max_tweaks: int = 2):
+        """Build (but don't save) a tweaked copy of a random rule from ``rules``."""
+        if not rules:
+            print("⚠️ No rules found in database to tweak.")
+            return None
+
+        rng = self._rng
+        original_rule = rules[rng.integers(len(rules))]
+        tweaked_json = copy.deepcopy(original_rule.rule_json)
+
+        filters = tweaked_json.get("filters", [])
+        if not filters:
+            print("⚠️ Selected rule has no filters to tweak.")
+            return None
+
+        # Draw every tweak up front, then apply them as plain dict writes
+        k = int(rng.integers(1, max_tweaks, endpoint=True))
+        idxs = rng.integers(len(filters), size=k)
+        types = rng.choice(TWEAK_TYPES, size=k)
+        factors = rng.uniform(0.8, 1.2, size=k)
+        signs = rng.choice(SIGNS, size=k)
+        periods = rng.choice(PERIODS, size=k)
+
+        for i, tweak_type, factor, sign, period in zip(idxs, types, factors, signs, periods):
+            f = filters[i]
+            if tweak_type == "threshold":
+                f["threshold"] = round(float(f["threshold"]) * float(factor), 2)
+            elif tweak_type == "sign":
+                f["sign"] = str(sign)
+            elif tweak_type == "period":
+                f["period"] = str(period)
+
+        return Rule(
+            name=f"Tweaked {original_rule.name} {rng.integers(1000, 9999, endpoint=True)}",
+            rule_json=tweaked_json,
+        )
+
+    def _random(self, all_filters, max_filters: int = 5):
+        """Build (but don't save) a brand-new random rule from ``all_filters``."""
+        if not all_filters:
+            print("⚠️ No filters available in database.")
+            return None
+
+        rng = self._rng
+        num_filters = int(rng.integers(1, max_filters, endpoint=True))
+        chosen_filters = [all_filters[i] for i in rng.choice(len(all_filters), num_filters, replace=False)]
+
+        # Every random value this rule needs, drawn in one go
+        signs = rng.choice(SIGNS, num_filters)
+        periods = rng.choice(PERIODS, num_filters)
+        unis = rng.random(num_filters)
+
+        new_filters = []
+        for f, sign, period, u in zip(chosen_filters, signs, periods, unis):
+            lo, hi, kind = _BUCKETS[f._bucket]
+            if kind == "int":
+                threshold = lo + int(u * (hi - lo + 1))  # uniform on [lo, hi]
+            else:
+                threshold = round(lo + float(u) * (hi - lo), 2)
+
+            # Python scalars only: rule_json is stored as JSON
+            new_filters.append({
+                "id": f.id,
+                "name": f.name,
+                "sign": str(sign),
+                "threshold": threshold,
+                "period": str(period),
+                "consisPeriod": None,
+            })
+
+        rule_json = {
+            "bt_period_start": "2000",
+            "bt_period_end": "2025",
+            "sign_mcap": ">=",
+            "mcap_threshold": 500,
+            "filters": new_filters,
+        }
+
+        return Rule(
+            name=f"Random Rule {rng.integers(1000, 9999, endpoint=True)}",
+            rule_json=rule_json,
+        )
+
     def tweak_rule(self, max_tweaks: int = 2):
         """Pick an existing rule, tweak it, and save a new version."""
         with Session(self.engine) as session:
             rules = session.query(Rule).all()
-            if not rules:
-                print("⚠️ No rules found in database to tweak.")
-                return None
-
-            original_rule = random.choice(rules)
-            tweaked_json = original_rule.rule_json.copy()
-
-            filters = tweaked_json.get("filters", [])
-            if not filters:
-                print("⚠️ Selected rule has no filters to tweak.")
+            new_rule = self._tweak(rules, max_tweaks)
+            if new_rule is None:
                 return None
 
-            for _ in range(random.randint(1, max_tweaks)):
-                f = random.choice(filters)
-
-                tweak_type = random.choice(["threshold", "sign", "period"])
-                if tweak_type == "threshold":
-                    f["threshold"] = round(
-                        float(f["threshold"]) * random.uniform(0.8, 1.2), 2
-                    )
-                elif tweak_type == "sign":
-                    f["sign"] = random.choice([">", "<", ">=", "<="])
-                elif tweak_type == "period":
-                    f["period"] = random.choice(["1Y", "3Y", "5Y", "10Y"])
-
-            new_rule = Rule(
-                name=f"Tweaked {original_rule.name} {random.randint(1000,9999)}",
-                rule_json=tweaked_json,
-            )
             session.add(new_rule)
-            self._safe_commit(session)
+            self._safe_commit(session, [new_rule])
 
-            print(f"🔧 Tweaked rule '{original_rule.name}' → '{new_rule.name}' (ID {new_rule.id})")
+            print(f"🔧 Tweaked rule → '{new_rule.name}' (ID {new_rule.id})")
             return new_rule
 
     def create_random_rule(self, max_filters: int = 5):
         """Generate a brand-new random rule from scratch."""
         with Session(self.engine) as session:
-            all_filters = session.query(Filter).all()
-            if not all_filters:
-                print("⚠️ No filters available in database.")
+            new_rule = self._random(_filter_catalog(self.engine), max_filters)
+            if new_rule is None:
                 return None
 
-            num_filters = random.randint(1, max_filters)
-            chosen_filters = random.sample(all_filters, num_filters)
-
-            new_filters = []
-            for f in chosen_filters:
-                sign = random.choice([">", "<", ">=", "<="])
-
-                if f.unit == "%" or "ROE" in f.name or "ROCE" in f.name:
-                    threshold = random.randint(5, 30)
-                elif "PE" in f.name or "PB" in f.name:
-                    threshold = round(random.uniform(5, 40), 2)
-                elif "Debt" in f.name:
-                    threshold = random.randint(0, 10)
-                elif "Dividend" in f.name:
-                    threshold = round(random.uniform(0.5, 8.0), 2)
-                else:
-                    threshold = round(random.uniform(1, 100), 2)
-
-                period = random.choice(["1Y", "3Y", "5Y", "10Y"])
-
-                new_filters.append({
-                    "id": f.id,
-                    "name": f.name,
-                    "sign": sign,
-                    "threshold": threshold,
-                    "period": period,
-                    "consisPeriod": None,
-                })
-
-            rule_json = {
-                "bt_period_start": "2000",
-                "bt_period_end": "2025",
-                "sign_mcap": ">=",
-                "mcap_threshold": 500,
-                "filters": new_filters,
-            }
-
-            new_rule = Rule(
-                name=f"Random Rule {random.randint(1000,9999)}",
-                rule_json=rule_json,
-            )
             session.add(new_rule)
-            self._safe_commit(session)
+            self._safe_commit(session, [new_rule])
 
             print(f"✨ Created brand-new rule '{new_rule.name}' (ID {new_rule.id})")
             return new_rule
 
     def evolve(self, n_tweaks: int = 5, n_random: int = 5):
-        """Run a full evolution step: tweak rules & create new ones."""
-        results = []
-        for _ in range(n_tweaks):
-            r = self.tweak_rule()
-            if r:
-                results.append(r)
-        for _ in range(n_random):
-            r = self.create_random_rule()
-            if r:
-                results.append(r)
+        """Run a full evolution step: tweak rules & create new ones.
+
+        Rules and filters are loaded once and all new rules are saved in a
+        single transaction.
+        """
+        with Session(self.engine) as session:
+            rules = session.query(Rule).all()
+            all_filters = _filter_catalog(self.engine)
+
+            results = [self._tweak(rules) for _ in range(n_tweaks)]
+            results += [self._random(all_filters) for _ in range(n_random)]
+            results = [r for r in results if r is not None]
+
+            session.add_all(results)
+            self._safe_commit(session, results)
+
+            for r in results:
+                print(f"🧬 Saved rule '{r.name}' (ID {r.id})")
         print(f"✅ Evolution complete: {len(results)} new rules created.")
         return results